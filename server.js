@@ -4,10 +4,19 @@ const express = require('express');
 const cors = require('cors');
 const fetch = require('node-fetch');
 const path = require('path');
+const fs = require('fs');
+const crypto = require('crypto');
+const cluster = require('cluster');
+const os = require('os');
+const https = require('https');
 const GeoTIFF = require('geotiff');
 
 const app = express();
 const PORT = process.env.PORT || 3000;
+// Число процессов-воркеров: WEB_CONCURRENCY=auto — по числу ядер, по умолчанию один процесс
+const WORKERS = process.env.WEB_CONCURRENCY === 'auto'
+    ? os.cpus().length
+    : parseInt(process.env.WEB_CONCURRENCY, 10) || 1;
 
 // ========== ПРОВЕРКА ПЕРЕМЕННЫХ ОКРУЖЕНИЯ ==========
 const CLIENT_ID = process.env.CLIENT_ID;
@@ -18,15 +27,31 @@ if (!CLIENT_ID || !CLIENT_SECRET) {
     process.exit(1);
 }
 
+// Пул keep-alive соединений к Sentinel Hub: без повторных TCP/TLS рукопожатий
+const sentinelAgent = new https.Agent({ keepAlive: true, maxSockets: 8 });
+const TOKEN_TIMEOUT = 10000;
+const PROCESS_TIMEOUT = 30000;
+
 // Кэширование токена
 let cachedToken = null;
 let tokenExpiry = 0;
+let tokenRequest = null; // Запрос токена в процессе выполнения
 
 async function getAccessToken() {
     if (cachedToken && Date.now() < tokenExpiry - 300000) {
         return cachedToken;
     }
 
+    // Параллельные анализы ждут один и тот же запрос токена, а не отправляют свои
+    if (!tokenRequest) {
+        tokenRequest = requestAccessToken().finally(() => {
+            tokenRequest = null;
+        });
+    }
+    return tokenRequest;
+}
+
+async function requestAccessToken() {
     const tokenUrl = 'https://services.sentinel-hub.com/oauth/token';
     const params = new URLSearchParams();
     params.append('grant_type', 'client_credentials');
@@ -36,7 +61,9 @@ async function getAccessToken() {
     const response = await fetch(tokenUrl, {
         method: 'POST',
         headers: { 'Content-Type': 'application/x-www-form-urlencoded' },
-        body: params
+        body: params,
+        agent: sentinelAgent,
+        timeout: TOKEN_TIMEOUT
     });
 
     if (!response.ok) {
@@ -50,77 +77,208 @@ async function getAccessToken() {
     return cachedToken;
 }
 
+// Кэширование растров NDVI (Process API) по bbox и периоду
+const RASTER_CACHE_TTL = 24 * 60 * 60 * 1000; // Снимки обновляются не чаще раза в сутки
+const RASTER_CACHE_MAX_ENTRIES = 200;
+const rasterCache = new Map();
+
+function rasterCacheKey(bbox, from, to) {
+    // ~10 м точности: повторный анализ того же поля попадает в кэш
+    return `${bbox.map(v => v.toFixed(4)).join(',')}|${from}|${to}`;
+}
+
+function getCachedRaster(key) {
+    const entry = rasterCache.get(key);
+    if (!entry) return null;
+    if (Date.now() > entry.expiry) {
+        rasterCache.delete(key);
+        return null;
+    }
+    return entry.raster;
+}
+
+function setCachedRaster(key, raster) {
+    if (rasterCache.size >= RASTER_CACHE_MAX_ENTRIES) {
+        // Map хранит порядок вставки: удаляем самую старую запись
+        rasterCache.delete(rasterCache.keys().next().value);
+    }
+    rasterCache.set(key, { raster, expiry: Date.now() + RASTER_CACHE_TTL });
+}
+
+// Запросы, которые Process API отклонил как некорректные (400/422): не повторяем их до истечения TTL
+const RASTER_REJECTED_MAX_ENTRIES = 1000;
+const rejectedRasterRequests = new Map(); // ключ кэша -> время истечения
+
+function isRasterRequestRejected(key) {
+    const expiry = rejectedRasterRequests.get(key);
+    if (expiry === undefined) return false;
+    if (Date.now() > expiry) {
+        rejectedRasterRequests.delete(key);
+        return false;
+    }
+    return true;
+}
+
+function markRasterRequestRejected(key) {
+    if (rejectedRasterRequests.size >= RASTER_REJECTED_MAX_ENTRIES) {
+        rejectedRasterRequests.delete(rejectedRasterRequests.keys().next().value);
+    }
+    rejectedRasterRequests.set(key, Date.now() + RASTER_CACHE_TTL);
+}
+
+// Ответы API уникальны для каждого запроса: не тратим время на хэширование тела под ETag
+app.set('etag', false);
+
 app.use(cors());
 app.use(express.json());
+
+// Главная страница читается один раз при старте и отдаётся из памяти с готовым ETag
+const INDEX_PATH = path.join(__dirname, 'public', 'index.html');
+const INDEX_HTML = fs.readFileSync(INDEX_PATH);
+const INDEX_ETAG = `"${crypto.createHash('md5').update(INDEX_HTML).digest('hex')}"`;
+const INDEX_LAST_MODIFIED = fs.statSync(INDEX_PATH).mtime.toUTCString();
+
+app.get('/', (req, res) => {
+    res.set({
+        'ETag': INDEX_ETAG,
+        'Last-Modified': INDEX_LAST_MODIFIED,
+        'Cache-Control': 'no-cache'
+    });
+    // res.send сам ответит 304, если у клиента актуальная копия
+    res.type('html').send(INDEX_HTML);
+});
+
 app.use(express.static(path.join(__dirname, 'public')));
 
+// Проверка работоспособности: тело ответа постоянное и сериализуется один раз
+const HEALTH_BODY = Buffer.from(JSON.stringify({ status: 'ok', version: require('./package.json').version }));
+
+app.get('/api/health', (req, res) => {
+    res.type('json').send(HEALTH_BODY);
+});
+
 // ========== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ==========
 
 /**
- * Разбивает массив 100x100 на 3x3 блока и возвращает средние значения для каждого блока.
+ * Округляет NDVI до 4 знаков для ответа: короче JSON и быстрее сериализация.
  */
-function aggregateTo3x3(ndviArray) {
-    const blockSize = 100 / 3; // 33.33, нецелое, поэтому используем округление границ
-    const result = Array(3).fill().map(() => Array(3).fill(0));
+function roundNdvi(value) {
+    return Math.round(value * 10000) / 10000;
+}
 
-    for (let i = 0; i < 3; i++) {
-        for (let j = 0; j < 3; j++) {
-            // Определяем границы блока в пикселях
-            const xStart = Math.floor(i * blockSize);
-            const xEnd = Math.floor((i + 1) * blockSize);
-            const yStart = Math.floor(j * blockSize);
-            const yEnd = Math.floor((j + 1) * blockSize);
-
-            let sum = 0;
-            let count = 0;
-            for (let x = xStart; x < xEnd; x++) {
-                for (let y = yStart; y < yEnd; y++) {
-                    if (x < 100 && y < 100 && !isNaN(ndviArray[y][x])) {
-                        sum += ndviArray[y][x];
-                        count++;
-                    }
-                }
+/**
+ * Пиксель растра содержит NDVI; no-data (обычно -9999) и NaN отбрасываются.
+ */
+function isValidNdvi(val) {
+    return val >= -1 && val <= 1;
+}
+
+/**
+ * Номер блока 3x3 (0..2) для каждого из `size` пикселей по одной оси.
+ */
+function blockIndex(size) {
+    const blockSize = size / 3; // Нецелое, поэтому используем округление границ
+    const blockOf = new Uint8Array(size);
+    for (let b = 0; b < 3; b++) {
+        const end = b === 2 ? size : Math.floor((b + 1) * blockSize);
+        blockOf.fill(b, Math.floor(b * blockSize), end);
+    }
+    return blockOf;
+}
+
+/**
+ * Разбивает растр NDVI (плоский массив width×height по строкам) на 3x3 блока.
+ * За один проход по пикселям возвращает средние значения блоков (matrix),
+ * а также сумму, сумму квадратов и число валидных пикселей всего растра.
+ */
+function aggregateTo3x3(data, width, height) {
+    const sums = new Float64Array(9);
+    const counts = new Uint32Array(9);
+    let sumSq = 0;
+    const colBlock = blockIndex(width);
+    const rowBlock = blockIndex(height);
+
+    for (let y = 0; y < height; y++) {
+        const offset = y * width;
+        const rowBase = rowBlock[y] * 3;
+        for (let x = 0; x < width; x++) {
+            const val = data[offset + x];
+            if (isValidNdvi(val)) {
+                const b = rowBase + colBlock[x];
+                sums[b] += val;
+                counts[b]++;
+                sumSq += val * val;
             }
-            result[j][i] = count > 0 ? sum / count : 0; // Индексы: j - lat, i - lng
         }
     }
-    return result;
+
+    const matrix = Array(3).fill().map(() => Array(3).fill(0));
+    let sum = 0;
+    let count = 0;
+    for (let j = 0; j < 3; j++) {
+        for (let i = 0; i < 3; i++) {
+            const b = j * 3 + i;
+            matrix[j][i] = counts[b] > 0 ? sums[b] / counts[b] : 0; // Индексы: j - lat, i - lng
+            sum += sums[b];
+            count += counts[b];
+        }
+    }
+    return { matrix, sum, sumSq, count };
 }
 
+// Классы состояния по NDVI: нижняя граница, подпись ячейки, цвет на карте
+// и подпись общего состояния поля
+const NDVI_CLASSES = [
+    { min: 0.7, health: 'отлично', color: '#2e7d32', overall: 'отличное' },
+    { min: 0.55, health: 'хорошо', color: '#7cb342', overall: 'хорошее' },
+    { min: 0.4, health: 'средне', color: '#fbc02d', overall: 'среднее' },
+    { min: 0.25, health: 'плохо', color: '#f57c00', overall: 'плохое' },
+    { min: -Infinity, health: 'критично', color: '#d32f2f', overall: 'критическое' }
+];
+
+/**
+ * Возвращает класс состояния (подписи и цвет) для значения NDVI.
+ */
+function classifyNdvi(ndvi) {
+    for (const cls of NDVI_CLASSES) {
+        if (ndvi >= cls.min) return cls;
+    }
+    return NDVI_CLASSES[NDVI_CLASSES.length - 1]; // NaN
+}
+
+// Ячейки с NDVI ниже порога считаются зонами стресса
+const STRESS_NDVI = 0.3;
+
 /**
  * Генерирует GeoJSON FeatureCollection для сетки 3×3 на основе матрицы значений.
+ * Попутно считает среднее NDVI и собирает ячейки зон стресса.
  */
 function generateGridFromMatrix(bbox, matrix) {
     const [minLng, minLat, maxLng, maxLat] = bbox;
     const stepX = (maxLng - minLng) / 3;
     const stepY = (maxLat - minLat) / 3;
 
+    // Границы ячеек считаются один раз; соседние ячейки делят общие рёбра
+    const xs = [minLng, minLng + stepX, minLng + 2 * stepX, minLng + 3 * stepX];
+    const ys = [minLat, minLat + stepY, minLat + 2 * stepY, minLat + 3 * stepY];
+
     const gridCells = [];
-    const ndviValues = [];
+    const stressFeatures = [];
+    let ndviSum = 0;
 
     for (let i = 0; i < 3; i++) {
         for (let j = 0; j < 3; j++) {
             const ndvi = matrix[j][i]; // j - lat, i - lng
-            ndviValues.push(ndvi);
-
-            let health;
-            if (ndvi >= 0.7) health = 'отлично';
-            else if (ndvi >= 0.55) health = 'хорошо';
-            else if (ndvi >= 0.4) health = 'средне';
-            else if (ndvi >= 0.25) health = 'плохо';
-            else health = 'критично';
-
-            const color = ndvi >= 0.7 ? '#2e7d32' :
-                         ndvi >= 0.55 ? '#7cb342' :
-                         ndvi >= 0.4 ? '#fbc02d' :
-                         ndvi >= 0.25 ? '#f57c00' : '#d32f2f';
-
-            const cellMinLng = minLng + i * stepX;
-            const cellMaxLng = minLng + (i + 1) * stepX;
-            const cellMinLat = minLat + j * stepY;
-            const cellMaxLat = minLat + (j + 1) * stepY;
-
-            gridCells.push({
+            ndviSum += ndvi;
+
+            const { health, color } = classifyNdvi(ndvi);
+
+            const cellMinLng = xs[i];
+            const cellMaxLng = xs[i + 1];
+            const cellMinLat = ys[j];
+            const cellMaxLat = ys[j + 1];
+
+            const feature = {
                 type: 'Feature',
                 properties: { ndvi, health, color },
                 geometry: {
@@ -133,30 +291,89 @@ function generateGridFromMatrix(bbox, matrix) {
                         [cellMinLng, cellMinLat]
                     ]]
                 }
-            });
+            };
+            gridCells.push(feature);
+            if (ndvi < STRESS_NDVI) stressFeatures.push(feature);
         }
     }
 
-    const avgNdvi = ndviValues.reduce((a, b) => a + b, 0) / ndviValues.length;
-
     return {
         grid: { type: 'FeatureCollection', features: gridCells },
-        avgNdvi
+        avgNdvi: ndviSum / gridCells.length,
+        stressFeatures
+    };
+}
+
+/**
+ * Детерминированный генератор псевдослучайных чисел в [0, 1) (mulberry32),
+ * инициализируемый строкой: одно и то же поле за тот же период даёт тот же ряд.
+ */
+function seededRandom(seedText) {
+    let seed = 2166136261; // FNV-1a
+    for (let i = 0; i < seedText.length; i++) {
+        seed = Math.imul(seed ^ seedText.charCodeAt(i), 16777619);
+    }
+    return () => {
+        seed = (seed + 0x6D2B79F5) | 0;
+        let t = Math.imul(seed ^ (seed >>> 15), 1 | seed);
+        t = (t + Math.imul(t ^ (t >>> 7), 61 | t)) ^ t;
+        return ((t ^ (t >>> 14)) >>> 0) / 4294967296;
     };
 }
 
+// Формат подписей дат на графике (ДД.ММ); один экземпляр вместо toLocaleDateString на каждый день
+const dayMonthFormat = new Intl.DateTimeFormat('ru-RU', { day: '2-digit', month: '2-digit' });
+const periodLabelCache = new Map();
+
+/**
+ * Возвращает подписи дат за последние `period` дней до `endDate` включительно.
+ * Результат кэшируется на текущие сутки.
+ */
+function getPeriodDateLabels(endDate, period) {
+    const key = `${endDate.toDateString()}|${period}`;
+    let labels = periodLabelCache.get(key);
+    if (!labels) {
+        if (periodLabelCache.size >= 32) periodLabelCache.clear(); // Старые сутки больше не нужны
+        labels = [];
+        for (let i = period; i >= 0; i--) {
+            const d = new Date(endDate);
+            d.setDate(endDate.getDate() - i);
+            labels.push(dayMonthFormat.format(d));
+        }
+        periodLabelCache.set(key, labels);
+    }
+    return labels;
+}
+
+/**
+ * Возвращает подписи `days` дней, следующих за `endDate`.
+ */
+function getForecastDateLabels(endDate, days) {
+    const labels = [];
+    const d = new Date(endDate);
+    for (let i = 0; i < days; i++) {
+        d.setDate(d.getDate() + 1);
+        labels.push(dayMonthFormat.format(d));
+    }
+    return labels;
+}
+
 /**
  * Простой линейный прогноз на 7 дней по последним точкам временного ряда.
  */
 function linearForecast(values, days = 7) {
     if (values.length < 2) return Array(days).fill(values[0] || 0.5);
 
+    // Суммы по x = 0..n-1 известны в закрытой форме; по y — один проход
     const n = values.length;
-    const indices = Array.from({ length: n }, (_, i) => i);
-    const sumX = indices.reduce((a, b) => a + b, 0);
-    const sumY = values.reduce((a, b) => a + b, 0);
-    const sumXY = indices.reduce((a, i) => a + i * values[i], 0);
-    const sumX2 = indices.reduce((a, i) => a + i * i, 0);
+    const sumX = n * (n - 1) / 2;
+    const sumX2 = (n - 1) * n * (2 * n - 1) / 6;
+    let sumY = 0;
+    let sumXY = 0;
+    for (let i = 0; i < n; i++) {
+        sumY += values[i];
+        sumXY += i * values[i];
+    }
 
     const slope = (n * sumXY - sumX * sumY) / (n * sumX2 - sumX * sumX);
     const intercept = (sumY - slope * sumX) / n;
@@ -170,253 +387,359 @@ function linearForecast(values, days = 7) {
     return forecast;
 }
 
-// ========== ОСНОВНОЙ ОБРАБОТЧИК ==========
-app.post('/api/analyze', async (req, res) => {
-    const { polygon, crop, period } = req.body;
-    if (!polygon || polygon.length < 3) {
-        return res.status(400).json({ error: 'Не указан или некорректен полигон' });
+// ========== АНАЛИЗ ПОЛЯ ==========
+
+// Запросы растров в процессе выполнения, по ключу кэша
+const pendingRasters = new Map();
+
+/**
+ * Запрашивает растр NDVI у Process API и декодирует GeoTIFF.
+ * Возвращает { width, height, data } или null, если Process API отклонил сам запрос
+ * (400/422). Прочие ошибки, включая 404 и 408, выбрасываются и не кэшируются.
+ */
+async function requestNdviRaster(accessToken, processPayload) {
+    const processResponse = await fetch('https://services.sentinel-hub.com/api/v1/process', {
+        method: 'POST',
+        headers: {
+            'Authorization': `Bearer ${accessToken}`,
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify(processPayload),
+        agent: sentinelAgent,
+        timeout: PROCESS_TIMEOUT
+    });
+
+    if (!processResponse.ok) {
+        const { status } = processResponse;
+        const errorText = await processResponse.text();
+        if (status !== 400 && status !== 422) {
+            throw new Error(`Process API вернул ${status}: ${errorText}`);
+        }
+        console.warn(`⚠️ Process API отклонил запрос (код ${status}): ${errorText}`);
+        return null;
     }
 
-    try {
-        // --- Вычисление bbox ---
-        let minLng = Infinity, maxLng = -Infinity, minLat = Infinity, maxLat = -Infinity;
-        polygon.forEach(([lng, lat]) => {
-            minLng = Math.min(minLng, lng);
-            maxLng = Math.max(maxLng, lng);
-            minLat = Math.min(minLat, lat);
-            maxLat = Math.max(maxLat, lat);
-        });
+    console.log('✅ Данные получены от Sentinel Hub (Process API)');
+    const arrayBuffer = await processResponse.arrayBuffer();
+    const tiff = await GeoTIFF.fromArrayBuffer(arrayBuffer);
+    const image = await tiff.getImage();
+    const rasters = await image.readRasters();
+    // Предполагаем один канал
+    return {
+        width: image.getWidth(),
+        height: image.getHeight(),
+        data: rasters[0] // Float32Array
+    };
+}
 
-        const lngPad = (maxLng - minLng) * 0.1;
-        const latPad = (maxLat - minLat) * 0.1;
-        minLng -= lngPad;
-        maxLng += lngPad;
-        minLat -= latPad;
-        maxLat += latPad;
-
-        const bbox = [minLng, minLat, maxLng, maxLat];
-        const centerLat = (minLat + maxLat) / 2;
-        const centerLng = (minLng + maxLng) / 2;
-
-        // --- Подготовка дат ---
-        const endDate = new Date();
-        const startDate = new Date();
-        startDate.setDate(endDate.getDate() - period);
-        const formatDate = (date) => date.toISOString().split('T')[0];
-
-        console.log(`\n📡 Запрос данных за период ${formatDate(startDate)} - ${formatDate(endDate)}`);
-
-        // --- Получение токена ---
-        const accessToken = await getAccessToken();
-
-        // --- Формирование запроса к Process API (реальный NDVI) ---
-        const evalscript = `
-            //VERSION=3
-            function setup() {
-                return {
-                    input: ["B04", "B08"],
-                    output: { bands: 1, sampleType: "FLOAT32" }
-                };
-            }
-            function evaluatePixel(sample) {
-                let ndvi = (sample.B08 - sample.B04) / (sample.B08 + sample.B04 + 0.000001);
-                return [ndvi];
-            }
-        `;
-
-        const processPayload = {
-            input: {
-                bounds: {
-                    bbox: bbox,
-                    properties: { crs: "http://www.opengis.net/def/crs/EPSG/0/4326" }
-                },
-                data: [{
-                    type: "sentinel-2-l2a",
-                    dataFilter: {
-                        timeRange: {
-                            from: `${formatDate(startDate)}T00:00:00Z`,
-                            to: `${formatDate(endDate)}T23:59:59Z`
-                        },
-                        maxCloudCoverage: 20
-                    }
-                }]
-            },
-            output: {
-                width: 100,
-                height: 100,
-                responses: [{
-                    identifier: "default",
-                    format: { type: "image/tiff" }
-                }]
-            },
-            evalscript: evalscript
-        };
+/**
+ * Анализирует одно поле: NDVI за период, сетка 3×3, зоны стресса, прогноз и рекомендация.
+ */
+async function analyzeField({ polygon, period }) {
+    // --- Вычисление bbox ---
+    let minLng = Infinity, maxLng = -Infinity, minLat = Infinity, maxLat = -Infinity;
+    polygon.forEach(([lng, lat]) => {
+        minLng = Math.min(minLng, lng);
+        maxLng = Math.max(maxLng, lng);
+        minLat = Math.min(minLat, lat);
+        maxLat = Math.max(maxLat, lat);
+    });
 
-        let ndviMatrix = null;
-        let usingRealData = true;
-        let avgNdvi, stdDev;
+    const lngPad = (maxLng - minLng) * 0.1;
+    const latPad = (maxLat - minLat) * 0.1;
+    minLng -= lngPad;
+    maxLng += lngPad;
+    minLat -= latPad;
+    maxLat += latPad;
+
+    const bbox = [minLng, minLat, maxLng, maxLat];
+    const centerLat = (minLat + maxLat) / 2;
+    const centerLng = (minLng + maxLng) / 2;
+
+    // --- Подготовка дат ---
+    const endDate = new Date();
+    const startDate = new Date();
+    startDate.setDate(endDate.getDate() - period);
+    const formatDate = (date) => date.toISOString().split('T')[0];
+
+    console.log(`\n📡 Запрос данных за период ${formatDate(startDate)} - ${formatDate(endDate)}`);
+
+    const rasterKey = rasterCacheKey(bbox, formatDate(startDate), formatDate(endDate));
+    let raster = getCachedRaster(rasterKey);
+    const rasterRejected = !raster && isRasterRequestRejected(rasterKey);
+
+    // --- Получение токена (не нужен, если ответ на этот запрос уже в кэше) ---
+    const accessToken = raster || rasterRejected ? null : await getAccessToken();
+
+    // --- Формирование запроса к Process API (реальный NDVI) ---
+    const evalscript = `
+        //VERSION=3
+        function setup() {
+            return {
+                input: ["B04", "B08"],
+                output: { bands: 1, sampleType: "FLOAT32" }
+            };
+        }
+        function evaluatePixel(sample) {
+            let ndvi = (sample.B08 - sample.B04) / (sample.B08 + sample.B04 + 0.000001);
+            return [ndvi];
+        }
+    `;
 
-        try {
-            const processResponse = await fetch('https://services.sentinel-hub.com/api/v1/process', {
-                method: 'POST',
-                headers: {
-                    'Authorization': `Bearer ${accessToken}`,
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify(processPayload)
-            });
-
-            if (!processResponse.ok) {
-                const errorText = await processResponse.text();
-                console.warn(`⚠️ Не удалось получить реальные данные (код ${processResponse.status}): ${errorText}`);
-                usingRealData = false;
-            } else {
-                console.log('✅ Данные получены от Sentinel Hub (Process API)');
-                const arrayBuffer = await processResponse.arrayBuffer();
-                const tiff = await GeoTIFF.fromArrayBuffer(arrayBuffer);
-                const image = await tiff.getImage();
-                const rasters = await image.readRasters();
-                // Предполагаем один канал
-                const width = image.getWidth();
-                const height = image.getHeight();
-                const data = rasters[0]; // Float32Array
-
-                // Преобразуем в 2D массив
-                ndviMatrix = [];
-                for (let y = 0; y < height; y++) {
-                    const row = [];
-                    for (let x = 0; x < width; x++) {
-                        let val = data[y * width + x];
-                        // Заменяем no-data (обычно -9999) на NaN
-                        if (val < -1 || val > 1) val = NaN;
-                        row.push(val);
-                    }
-                    ndviMatrix.push(row);
+    const processPayload = {
+        input: {
+            bounds: {
+                bbox: bbox,
+                properties: { crs: "http://www.opengis.net/def/crs/EPSG/0/4326" }
+            },
+            data: [{
+                type: "sentinel-2-l2a",
+                dataFilter: {
+                    timeRange: {
+                        from: `${formatDate(startDate)}T00:00:00Z`,
+                        to: `${formatDate(endDate)}T23:59:59Z`
+                    },
+                    maxCloudCoverage: 20
                 }
+            }]
+        },
+        output: {
+            width: 100,
+            height: 100,
+            responses: [{
+                identifier: "default",
+                format: { type: "image/tiff" }
+            }]
+        },
+        evalscript: evalscript
+    };
 
-                // Вычисляем общее среднее и стандартное отклонение
-                const validValues = ndviMatrix.flat().filter(v => !isNaN(v));
-                if (validValues.length === 0) {
-                    throw new Error('Нет валидных пикселей (возможно, все закрыты облаками)');
-                }
-                avgNdvi = validValues.reduce((a, b) => a + b, 0) / validValues.length;
-                const mean = avgNdvi;
-                const squaredDiffs = validValues.map(v => Math.pow(v - mean, 2));
-                stdDev = Math.sqrt(squaredDiffs.reduce((a, b) => a + b, 0) / validValues.length);
+    let usingRealData = true;
+    let avgNdvi, stdDev;
+    let ndviMatrix3x3 = null;
 
-                console.log(`📊 Средний NDVI за период: ${avgNdvi.toFixed(3)}, ст.отклонение: ${stdDev.toFixed(3)}`);
-            }
-        } catch (err) {
-            console.warn('⚠️ Ошибка при запросе Process API. Использую тестовые данные.', err.message);
+    try {
+        if (raster) {
+            console.log('♻️ Данные Sentinel Hub взяты из кэша');
+        } else if (rasterRejected) {
+            console.log('♻️ Process API ранее отклонил этот запрос, использую тестовые данные');
             usingRealData = false;
-        }
-
-        // --- Генерация временного ряда (тестового, но с реальным средним) ---
-        let timeSeries = { dates: [], values: [] };
-        if (usingRealData && avgNdvi !== undefined) {
-            // Создаём тестовый временной ряд, колеблющийся вокруг реального среднего
-            for (let i = period; i >= 0; i--) {
-                const d = new Date();
-                d.setDate(endDate.getDate() - i);
-                timeSeries.dates.push(d.toLocaleDateString('ru-RU', { day: '2-digit', month: '2-digit' }));
-                // Генерируем значение с небольшими колебаниями
-                let val = avgNdvi + Math.sin(i / 5) * 0.05 + (Math.random() * 0.02 - 0.01);
-                val = Math.min(0.9, Math.max(0.1, val));
-                timeSeries.values.push(val);
-            }
         } else {
-            // Полностью тестовые данные
-            console.log('🧪 Генерация тестовых данных');
-            for (let i = period; i >= 0; i--) {
-                const d = new Date();
-                d.setDate(endDate.getDate() - i);
-                timeSeries.dates.push(d.toLocaleDateString('ru-RU', { day: '2-digit', month: '2-digit' }));
-                timeSeries.values.push(0.5 + Math.sin(i / 10) * 0.2 + (Math.random() * 0.1));
+            // Одинаковые поля, анализируемые одновременно, ждут один запрос к Process API
+            let pending = pendingRasters.get(rasterKey);
+            if (!pending) {
+                pending = requestNdviRaster(accessToken, processPayload).finally(() => {
+                    pendingRasters.delete(rasterKey);
+                });
+                pendingRasters.set(rasterKey, pending);
+            }
+            raster = await pending;
+            if (raster) {
+                setCachedRaster(rasterKey, raster);
+            } else {
+                markRasterRequestRejected(rasterKey);
+                usingRealData = false;
             }
-            avgNdvi = timeSeries.values.reduce((a, b) => a + b, 0) / timeSeries.values.length;
-            stdDev = 0.15;
         }
 
-        // --- Прогноз ---
-        const forecastValues = linearForecast(timeSeries.values.slice(-5), 7);
-        const forecast = {
-            dates: Array.from({ length: 7 }, (_, i) => {
-                const d = new Date();
-                d.setDate(endDate.getDate() + i + 1);
-                return d.toLocaleDateString('ru-RU', { day: '2-digit', month: '2-digit' });
-            }),
-            values: forecastValues
-        };
-
-        // --- Сетка 3×3 на основе реальных данных (если есть) ---
-        let grid;
-        if (usingRealData && ndviMatrix) {
-            // Агрегируем 100x100 в 3x3
-            const matrix3x3 = aggregateTo3x3(ndviMatrix);
-            const gridResult = generateGridFromMatrix(bbox, matrix3x3);
-            grid = gridResult.grid;
-            // Пересчитываем среднее по сетке (оно может немного отличаться от общего среднего)
-            avgNdvi = gridResult.avgNdvi;
-        } else {
-            // Генерация тестовой сетки на основе среднего и ст. отклонения
-            const { grid: testGrid } = generateGridFromMatrix(bbox, [
-                [avgNdvi + 0.1, avgNdvi - 0.05, avgNdvi + 0.02],
-                [avgNdvi - 0.03, avgNdvi + 0.07, avgNdvi - 0.08],
-                [avgNdvi + 0.04, avgNdvi - 0.02, avgNdvi + 0.05]
-            ]);
-            grid = testGrid;
+        if (raster) {
+            const { width, height, data } = raster;
+
+            // Блоки 3x3 и общие среднее/ст. отклонение — за один проход по растру
+            const { matrix, sum, sumSq, count } = aggregateTo3x3(data, width, height);
+            if (count === 0) {
+                throw new Error('Нет валидных пикселей (возможно, все закрыты облаками)');
+            }
+            ndviMatrix3x3 = matrix;
+            avgNdvi = sum / count;
+            stdDev = Math.sqrt(Math.max(0, sumSq / count - avgNdvi * avgNdvi));
+
+            console.log(`📊 Средний NDVI за период: ${avgNdvi.toFixed(3)}, ст.отклонение: ${stdDev.toFixed(3)}`);
         }
+    } catch (err) {
+        console.warn('⚠️ Ошибка при запросе Process API. Использую тестовые данные.', err.message);
+        usingRealData = false;
+    }
 
-        // --- Определение общего состояния ---
-        let overallHealth;
-        if (avgNdvi >= 0.7) overallHealth = 'отличное';
-        else if (avgNdvi >= 0.55) overallHealth = 'хорошее';
-        else if (avgNdvi >= 0.4) overallHealth = 'среднее';
-        else if (avgNdvi >= 0.25) overallHealth = 'плохое';
-        else overallHealth = 'критическое';
-
-        const stressFeatures = grid.features.filter(f => f.properties.ndvi < 0.3);
-        const stressPercent = (stressFeatures.length / grid.features.length) * 100;
-
-        // --- Рекомендация ---
-        let recommendation = '';
-        if (avgNdvi > 0.6) {
-            recommendation = `🌱 Состояние посевов хорошее. NDVI: ${avgNdvi.toFixed(2)}. Рекомендуется плановое внесение удобрений.`;
-        } else if (avgNdvi > 0.4) {
-            recommendation = `⚠️ Вегетация средняя (NDVI: ${avgNdvi.toFixed(2)}). Возможен дефицит влаги. Рекомендуется обследование.`;
-        } else {
-            recommendation = `❗ Критическое состояние (NDVI: ${avgNdvi.toFixed(2)}). Срочный полив и защита.`;
+    // --- Генерация временного ряда (тестового, но с реальным средним) ---
+    const timeSeries = { dates: getPeriodDateLabels(endDate, period), values: [] };
+    const values = timeSeries.values;
+    // Колебания привязаны к полю и периоду, поэтому повторный анализ даёт тот же результат
+    const random = seededRandom(rasterKey);
+    if (usingRealData && avgNdvi !== undefined) {
+        // Создаём тестовый временной ряд, колеблющийся вокруг реального среднего
+        for (let i = period; i >= 0; i--) {
+            // Генерируем значение с небольшими колебаниями
+            const val = avgNdvi + Math.sin(i / 5) * 0.05 + (random() * 0.02 - 0.01);
+            values.push(Math.min(0.9, Math.max(0.1, val)));
         }
-        if (stressPercent > 20) {
-            recommendation += `\n🔴 Зоны стресса: ${stressPercent.toFixed(0)}% площади — требуется точечная обработка.`;
+    } else {
+        // Полностью тестовые данные; среднее считаем в том же проходе
+        console.log('🧪 Генерация тестовых данных');
+        let sum = 0;
+        for (let i = period; i >= 0; i--) {
+            const val = 0.5 + Math.sin(i / 10) * 0.2 + (random() * 0.1);
+            values.push(val);
+            sum += val;
         }
+        avgNdvi = sum / values.length;
+        stdDev = 0.15;
+    }
 
-        // --- Итоговый ответ ---
-        const result = {
-            summary: {
-                avg_ndvi: avgNdvi,
-                health: overallHealth,
-                stress_percent: stressPercent,
-                center: { lat: centerLat, lon: centerLng }
-            },
-            recommendation,
-            health_grid: grid,
-            stress_zones: {
-                type: 'FeatureCollection',
-                features: grid.features.filter(f => f.properties.ndvi < 0.3)
-            },
-            time_series: timeSeries,
-            forecast,
-            data_source: usingRealData ? 'Sentinel-2 L2A (реальные данные, Process API)' : 'Тестовые данные (имитация)'
-        };
+    // --- Прогноз ---
+    const forecastValues = linearForecast(values.slice(-5), 7);
+    const forecast = {
+        dates: getForecastDateLabels(endDate, 7),
+        values: forecastValues
+    };
+
+    // --- Сетка 3×3 на основе реальных данных (если есть) ---
+    let gridResult;
+    if (usingRealData && ndviMatrix3x3) {
+        gridResult = generateGridFromMatrix(bbox, ndviMatrix3x3);
+        // Пересчитываем среднее по сетке (оно может немного отличаться от общего среднего)
+        avgNdvi = gridResult.avgNdvi;
+    } else {
+        // Генерация тестовой сетки на основе среднего и ст. отклонения
+        gridResult = generateGridFromMatrix(bbox, [
+            [avgNdvi + 0.1, avgNdvi - 0.05, avgNdvi + 0.02],
+            [avgNdvi - 0.03, avgNdvi + 0.07, avgNdvi - 0.08],
+            [avgNdvi + 0.04, avgNdvi - 0.02, avgNdvi + 0.05]
+        ]);
+    }
+    const { grid, stressFeatures } = gridResult;
 
-        res.json(result);
+    // --- Определение общего состояния ---
+    const overallHealth = classifyNdvi(avgNdvi).overall;
+
+    const stressPercent = (stressFeatures.length / grid.features.length) * 100;
+
+    // --- Рекомендация ---
+    let recommendation = '';
+    if (avgNdvi > 0.6) {
+        recommendation = `🌱 Состояние посевов хорошее. NDVI: ${avgNdvi.toFixed(2)}. Рекомендуется плановое внесение удобрений.`;
+    } else if (avgNdvi > 0.4) {
+        recommendation = `⚠️ Вегетация средняя (NDVI: ${avgNdvi.toFixed(2)}). Возможен дефицит влаги. Рекомендуется обследование.`;
+    } else {
+        recommendation = `❗ Критическое состояние (NDVI: ${avgNdvi.toFixed(2)}). Срочный полив и защита.`;
+    }
+    if (stressPercent > 20) {
+        recommendation += `\n🔴 Зоны стресса: ${stressPercent.toFixed(0)}% площади — требуется точечная обработка.`;
+    }
+
+    // --- Итоговый ответ ---
+    return {
+        summary: {
+            avg_ndvi: avgNdvi,
+            health: overallHealth,
+            stress_percent: stressPercent,
+            center: { lat: centerLat, lon: centerLng }
+        },
+        recommendation,
+        health_grid: grid,
+        stress_zones: {
+            type: 'FeatureCollection',
+            features: stressFeatures
+        },
+        time_series: {
+            dates: timeSeries.dates,
+            values: timeSeries.values.map(roundNdvi)
+        },
+        forecast: {
+            dates: forecast.dates,
+            values: forecast.values.map(roundNdvi)
+        },
+        data_source: usingRealData ? 'Sentinel-2 L2A (реальные данные, Process API)' : 'Тестовые данные (имитация)'
+    };
+}
+
+function isValidPolygon(polygon) {
+    return Array.isArray(polygon) && polygon.length >= 3;
+}
+
+// ========== ОСНОВНОЙ ОБРАБОТЧИК ==========
+app.post('/api/analyze', async (req, res) => {
+    if (!isValidPolygon(req.body.polygon)) {
+        return res.status(400).json({ error: 'Не указан или некорректен полигон' });
+    }
+
+    try {
+        res.json(await analyzeField(req.body));
     } catch (error) {
         console.error('❌ Критическая ошибка сервера:', error);
         res.status(500).json({ error: 'Внутренняя ошибка сервера', details: error.message });
     }
 });
 
-app.listen(PORT, () => {
-    console.log(`🚀 Сервер запущен на порту ${PORT}`);
-});
\ No newline at end of file
+// ========== ПАКЕТНЫЙ АНАЛИЗ ==========
+const BATCH_MAX_FIELDS = 20;
+
+/**
+ * Анализ нескольких полей одним запросом: { requests: [{ polygon, crop, period }, ...] }.
+ * Поля обрабатываются параллельно и делят токен, пул соединений и кэш растров.
+ * Ошибка одного поля не прерывает остальные — она возвращается на его месте в results.
+ */
+app.post('/api/analyze_batch', async (req, res) => {
+    const { requests } = req.body;
+    if (!Array.isArray(requests) || requests.length === 0) {
+        return res.status(400).json({ error: 'Не указан список полей' });
+    }
+    if (requests.length > BATCH_MAX_FIELDS) {
+        return res.status(400).json({ error: `Не более ${BATCH_MAX_FIELDS} полей за один запрос` });
+    }
+
+    const results = await Promise.all(requests.map(async (item) => {
+        if (!item || !isValidPolygon(item.polygon)) {
+            return { error: 'Не указан или некорректен полигон' };
+        }
+        try {
+            return await analyzeField(item);
+        } catch (error) {
+            console.error('❌ Ошибка анализа поля:', error);
+            return { error: 'Внутренняя ошибка сервера', details: error.message };
+        }
+    }));
+
+    res.json({ results });
+});
+
+if (WORKERS > 1 && (cluster.isPrimary ?? cluster.isMaster)) {
+    // Воркеры делят один порт; декодирование GeoTIFF и расчёты идут на разных ядрах
+    console.log(`🚀 Запуск ${WORKERS} воркеров на порту ${PORT}`);
+    for (let i = 0; i < WORKERS; i++) {
+        cluster.fork();
+    }
+    // Бюджет перезапусков: если воркеры падают слишком часто (например, порт занят),
+    // останавливаем весь сервер, а не перезапускаем их бесконечно
+    const RESTART_WINDOW = 60000;
+    const MAX_RESTARTS = 5;
+    const RESTART_DELAY = 1000;
+    let recentExits = [];
+
+    cluster.on('exit', (worker, code, signal) => {
+        if (worker.exitedAfterDisconnect || code === 0) {
+            console.log(`Воркер ${worker.process.pid} остановлен`);
+            return;
+        }
+
+        const now = Date.now();
+        recentExits = recentExits.filter(t => now - t < RESTART_WINDOW);
+        recentExits.push(now);
+        if (recentExits.length > MAX_RESTARTS) {
+            console.error(`❌ Воркеры завершились ${recentExits.length} раз за ${RESTART_WINDOW / 1000} с, остановка сервера`);
+            process.exit(1);
+        }
+
+        const delay = RESTART_DELAY * recentExits.length;
+        console.warn(`⚠️ Воркер ${worker.process.pid} завершился (${signal || code}), перезапуск через ${delay} мс`);
+        setTimeout(() => cluster.fork(), delay);
+    });
+} else {
+    const server = app.listen(PORT, () => {
+        console.log(`🚀 Сервер запущен на порту ${PORT} (pid ${process.pid})`);
+    });
+    server.on('error', (err) => {
+        console.error(`❌ Не удалось запустить сервер на порту ${PORT}: ${err.message}`);
+        process.exit(1);
+    });
+}